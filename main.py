@@ -1,18 +1,27 @@
 from argparse import ArgumentParser
+from concurrent.futures import ThreadPoolExecutor, wait
 from netmiko import ConnectHandler
 from datetime import datetime
 from dotenv import load_dotenv
-from dataclasses import dataclass, asdict
-from itertools import chain, filterfalse
+from itertools import chain, islice
 from jinja2 import Environment, FileSystemLoader
-from typing import Tuple
+from typing import Dict, Iterator, List, Optional, Set, Tuple, TypedDict
+import json
 import os
 import re
 
 
-@dataclass
-class L2VPN:
-    circuit_id: int
+EFP_ID_REGEX = re.compile(r'^\s+service instance (\d+) ethernet', re.MULTILINE)
+IP_SLA_ID_REGEX = re.compile(r'^ip sla (\d+)', re.MULTILINE)
+PUSH_READ_TIMEOUT_PER_LINE = 2
+
+
+CFM_DOMAIN = 'OPERATOR'
+CFM_LEVEL = 1
+
+
+class L2VPN(TypedDict):
+    circuit_id: str
     vcid: str
     interface: str
     vlan: int
@@ -21,47 +30,91 @@ class L2VPN:
     target_mpid: int
     slm_ip_sla_id: int
     dmm_ip_sla_id: int
-    ccm_interval: str = '1s'
-    cfm_domain: str = 'OPERATOR'
-    cfm_level: int = 1
-    enable_cfm_hw_offload: bool = False
+    ccm_interval: str
+    cfm_domain: str
+    cfm_level: int
+    enable_cfm_hw_offload: bool
+
+
+def get_used_efp_ids(device: ConnectHandler, interface: str) -> Set[int]:
+    output = device.send_command(f'show running-config interface {interface} | include service instance')
+
+    return {int(efp_id_match.group(1)) for efp_id_match in EFP_ID_REGEX.finditer(output)}
+
+
+def get_used_ip_sla_ids(device: ConnectHandler) -> Set[int]:
+    output = device.send_command('show running-config | include ^ip sla [0-9]')
+
+    return {int(ip_sla_id_match.group(1)) for ip_sla_id_match in IP_SLA_ID_REGEX.finditer(output)}
+
+
+def get_used_ids(device: ConnectHandler, interface: str) -> Tuple[Set[int], Set[int]]:
+    return get_used_efp_ids(device, interface), get_used_ip_sla_ids(device)
+
 
+def write_configs(filename: str, configs: List[str]) -> None:
+    with open(filename, mode='a') as config_file:
+        config_file.write('\n'.join(configs) + '\n')
 
-def get_next_available_efp_id(a_device: ConnectHandler, a_interface: str, z_device: ConnectHandler, z_interface: str) -> int:
-    efp_id_regex = r'\s+service instance (\d+) ethernet .*'
 
-    a_output = a_device.send_command(f'show running-config interface {a_interface} | include service instance')
-    a_efp_id_matches = re.findall(efp_id_regex, a_output)
-    a_all_efp_ids = set([int(efp_id) for efp_id in a_efp_id_matches])
+def push_config(device: ConnectHandler, configs: List[str]) -> str:
+    config: str = device.RETURN.join([*configs, 'end']) + device.RETURN
+    output = device.config_mode()
+    device.write_channel(config)
+    output += device.read_until_pattern(pattern=rf'{re.escape(device.base_prompt)}#', read_timeout=PUSH_READ_TIMEOUT_PER_LINE * config.count('\n'))
 
-    z_output = z_device.send_command(f'show running-config interface {z_interface} | include service instance')
-    z_efp_id_matches = re.findall(efp_id_regex, z_output)
-    z_all_efp_ids = set([int(efp_id) for efp_id in z_efp_id_matches])
+    return output
 
-    used_efp_ids = chain(a_all_efp_ids, z_all_efp_ids)
 
-    return next(filterfalse(lambda efp_id: efp_id in used_efp_ids, range(1, 4094)))
+def deprovision_device(device: ConnectHandler, deprovision_filename: str) -> None:
+    with open(deprovision_filename) as deprovision_file:
+        config = deprovision_file.read().splitlines()
+        push_config(device, config)
+    os.remove(deprovision_filename)
 
 
-def get_next_available_two_ip_sla_ids(a_device: ConnectHandler, z_device: ConnectHandler) -> Tuple[int, int]:
-    ip_sla_id_show_command = 'show running-config | include ^ip sla [0-9]'
-    ip_sla_id_regex = r'ip sla (\d+)'
+def load_state(state_filename: str) -> Optional[Dict[str, int]]:
+    if not os.path.exists(state_filename):
+        return None
 
-    a_output = a_device.send_command(ip_sla_id_show_command)
-    a_ip_sla_id_matches = re.findall(ip_sla_id_regex, a_output)
-    a_all_ip_sla_ids = set([int(ip_sla_id) for ip_sla_id in a_ip_sla_id_matches])
+    with open(state_filename) as state_file:
+        return json.load(state_file)
 
-    z_output = z_device.send_command(ip_sla_id_show_command)
-    z_ip_sla_id_matches = re.findall(ip_sla_id_regex, z_output)
-    z_all_ip_sla_ids = set([int(ip_sla_id) for ip_sla_id in z_ip_sla_id_matches])
 
-    used_ip_sla_ids = chain(a_all_ip_sla_ids, z_all_ip_sla_ids)
+def save_state(state_filename: str, efp_next: int, ip_sla_next: int) -> None:
+    previous_state: Optional[Dict[str, int]] = load_state(state_filename)
+    if previous_state:
+        efp_next = max(previous_state['efp_next'], efp_next)
+        ip_sla_next = max(previous_state['ip_sla_next'], ip_sla_next)
 
-    filtered_ip_sla_ids = filterfalse(lambda ip_sla_id: ip_sla_id in used_ip_sla_ids, range(1, 2147483647))
-    slm_ip_sla_id: int = next(filtered_ip_sla_ids)
-    dmm_ip_sla_id: int = next(filtered_ip_sla_ids)
+    with open(state_filename, mode='w') as state_file:
+        json.dump({'efp_next': efp_next, 'ip_sla_next': ip_sla_next}, state_file)
 
-    return [slm_ip_sla_id, dmm_ip_sla_id]
+
+def free_id_runs(used_ids: Set[int], start: int, stop: int) -> Iterator[range]:
+    run_start = start
+    for used_id in sorted(used_ids):
+        if used_id >= stop:
+            break
+        if used_id >= run_start:
+            if used_id > run_start:
+                yield range(run_start, used_id)
+            run_start = used_id + 1
+
+    if run_start < stop:
+        yield range(run_start, stop)
+
+
+def allocate_n_ids(used_ids: Set[int], count: int, start: int, stop: int) -> List[int]:
+    if count <= 0:
+        return []
+
+    free_runs: List[range] = list(free_id_runs(used_ids, start, stop))
+    id_range: Optional[range] = next((free_run[:count] for free_run in free_runs if len(free_run) >= count), None)
+    ids: List[int] = list(id_range if id_range is not None else islice(chain.from_iterable(free_runs), count))
+    used_ids.update(ids)
+
+    return ids
 
 
 def main():
@@ -81,94 +134,127 @@ def main():
     provision.add_argument('--z-interface', help='Provision the test L2VPN(s) on the Z device under this interface', dest='z_device_interface')
     provision.add_argument('--ccm-interval', help='Provision the test L2VPN(s) with this CCM transmit interval, in seconds (default 10s)', dest='ccm_interval', type=int, default=10)
     provision.add_argument('--hw-offload', help='Provision the test L2VPN(s) with CCM hardware offload enabled', dest='hw_offload', action='store_true', default=False)
+    provision.add_argument('--fast', help='Lower Netmiko\'s global delay factor from the fast_cli default of 0.1 to 0.05 to speed up the device sessions, at the risk of timing out on slow devices', dest='fast', action='store_true', default=False)
+    provision.add_argument('--trust-state', help='Allocate EFP/IP SLA IDs from the local state file left by a previous run, without checking the devices for IDs already in use', dest='trust_state', action='store_true', default=False)
     provision.add_argument('--dry-run', help='Don\'t provision the test L2VPN(s), just write the configuration that would be applied to the respective device filenames', dest='dry_run', action='store_true')
 
     deprovision = subparsers.add_parser('deprovision', help='Deprovision all previously provisioned test L2VPNs on the provided IOS-XE devices')
     deprovision.add_argument('a_device_ip_address', help='Deprovision all previously provisioned test L2VPNs using this IPv4 address as the A device')
     deprovision.add_argument('z_device_ip_address', help='Deprovision all previously provisioned test L2VPNs using this IPv4 address as the Z device')
+    deprovision.add_argument('--fast', help='Lower Netmiko\'s global delay factor from the fast_cli default of 0.1 to 0.05 to speed up the device sessions, at the risk of timing out on slow devices', dest='fast', action='store_true', default=False)
 
     args = parser.parse_args()
 
-    if not load_dotenv() or not os.getenv('username') or not os.getenv('password'):
+    dotenv_loaded: bool = load_dotenv()
+    username = os.getenv('username')
+    password = os.getenv('password')
+
+    if not dotenv_loaded or not username or not password:
         print('Failed to load .env file. Please create a .env file with the following parameters:\n\tusername: The user account that has access to log into the lab device(s) via SSH\n\tpassword: The password for the above user account.\n')
         return
 
     startTime = datetime.now()
 
-    a_device_options = {
-        'device_type': 'cisco_xe',
-        'host': args.a_device_ip_address,
-        'username': os.getenv('username'),
-        'password': os.getenv('password'),
-        'fast_cli': True
-    }
-
-    z_device_options = {
+    device_options = {
         'device_type': 'cisco_xe',
-        'host': args.z_device_ip_address,
-        'username': os.getenv('username'),
-        'password': os.getenv('password'),
-        'fast_cli': True
+        'username': username,
+        'password': password,
+        'fast_cli': True,
+        'global_delay_factor': 0.05 if args.fast else 1
     }
+    a_device_options = {**device_options, 'host': args.a_device_ip_address}
+    z_device_options = {**device_options, 'host': args.z_device_ip_address}
 
-    a_device = ConnectHandler(**a_device_options)
-    z_device = ConnectHandler(**z_device_options)
-
-    environment = Environment(loader=FileSystemLoader('.'))
+    environment = Environment(loader=FileSystemLoader('.'), auto_reload=False, trim_blocks=True, lstrip_blocks=True)
     a_device_deprovision_filename = f'{args.a_device_ip_address}_removal.cfg'
     z_device_deprovision_filename = f'{args.z_device_ip_address}_removal.cfg'
     a_device_dry_run_filename = f'{args.a_device_ip_address}_dry-run.cfg'
     z_device_dry_run_filename = f'{args.z_device_ip_address}_dry-run.cfg'
-
-    if args.subcommand == 'provision':
-        l2vpn_template = environment.get_template('l2vpn.j2')
-        l2vpn_deprovision_template = environment.get_template('l2vpn_deprovision.j2')
-
-        for i in range(args.n):
-            ip_sla_ids = get_next_available_two_ip_sla_ids(a_device, z_device)
-            slm_id=ip_sla_ids[0]
-            dmm_id=ip_sla_ids[1]
-            vlan: int = get_next_available_efp_id(a_device, args.a_device_interface, z_device, args.z_device_interface)
-            vlan_padded: str = '{:04d}'.format(vlan)
-            vcid: str = f'500{vlan_padded}'
-            circuit_id: str = vlan_padded
-
-            a_l2vpn = L2VPN(circuit_id=circuit_id, vcid=vcid, interface=args.a_device_interface, vlan=vlan, peer_router_loopback_ip_address=args.z_device_loopback_ip_address, source_mpid=1, target_mpid=2, slm_ip_sla_id=slm_id, dmm_ip_sla_id=dmm_id, ccm_interval=f'{args.ccm_interval}s', enable_cfm_hw_offload=args.hw_offload)
-            a_config: str = l2vpn_template.render(asdict(a_l2vpn))
-            z_l2vpn = L2VPN(circuit_id=circuit_id, vcid=vcid, interface=args.z_device_interface, vlan=vlan, peer_router_loopback_ip_address=args.a_device_loopback_ip_address, source_mpid=2, target_mpid=1, slm_ip_sla_id=slm_id, dmm_ip_sla_id=dmm_id, ccm_interval=f'{args.ccm_interval}s', enable_cfm_hw_offload=args.hw_offload)
-            z_config: str = l2vpn_template.render(asdict(z_l2vpn))
-
-            if args.dry_run:
-                with open(a_device_dry_run_filename, mode='a') as a_device_dry_run_file:
-                    a_device_dry_run_file.write(a_config)
-
-                with open(z_device_dry_run_filename, mode='a') as z_device_dry_run_file:
-                    z_device_dry_run_file.write(z_config)
-            else:
-                a_device.send_config_set(a_config.split('\n'), read_timeout=60)
-                a_device_deprovision_config: str = l2vpn_deprovision_template.render(asdict(a_l2vpn)) + '\n'
-
-                z_device.send_config_set(z_config.split('\n'), read_timeout=60)
-                z_device_deprovision_config: str = l2vpn_deprovision_template.render(asdict(z_l2vpn)) + '\n'
-
-                with open(a_device_deprovision_filename, mode='a') as a_device_deprovision_file:
-                    a_device_deprovision_file.write(a_device_deprovision_config)
-
-                with open(z_device_deprovision_filename, mode='a') as z_device_deprovision_file:
-                    z_device_deprovision_file.write(z_device_deprovision_config)
-                
-    elif args.subcommand == 'deprovision':
-        with open(a_device_deprovision_filename) as a_device_deprovision_file:
-            a_config = a_device_deprovision_file.read().split('\n')
-            a_device.send_config_set(a_config, read_timeout=60)
-        os.remove(a_device_deprovision_filename)
-        with open(z_device_deprovision_filename) as z_device_deprovision_file:
-            z_config = z_device_deprovision_file.read().split('\n')
-            z_device.send_config_set(z_config, read_timeout=60)
-        os.remove(z_device_deprovision_filename)
-
-    a_device.disconnect()
-    z_device.disconnect()
+    state_filename = f'{args.a_device_ip_address}_{args.z_device_ip_address}_state.json'
+
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        a_device_future = executor.submit(ConnectHandler, **a_device_options)
+        z_device_future = executor.submit(ConnectHandler, **z_device_options)
+        wait((a_device_future, z_device_future))
+
+        try:
+            a_device = a_device_future.result()
+            z_device = z_device_future.result()
+
+            if args.subcommand == 'provision':
+                l2vpn_template_module = environment.get_template('l2vpn.j2').module
+                render_l2vpn = l2vpn_template_module.provision
+                render_l2vpn_deprovision = l2vpn_template_module.deprovision
+
+                state: Optional[Dict[str, int]] = load_state(state_filename) if args.trust_state else None
+                efp_start: int = state['efp_next'] if state else 1
+                ip_sla_start: int = state['ip_sla_next'] if state else 1
+                used_efp_ids: Set[int] = set()
+                used_ip_sla_ids: Set[int] = set()
+
+                if not state:
+                    a_used_ids_future = executor.submit(get_used_ids, a_device, args.a_device_interface)
+                    z_used_ids_future = executor.submit(get_used_ids, z_device, args.z_device_interface)
+                    wait((a_used_ids_future, z_used_ids_future))
+                    a_used_efp_ids, a_used_ip_sla_ids = a_used_ids_future.result()
+                    z_used_efp_ids, z_used_ip_sla_ids = z_used_ids_future.result()
+                    used_efp_ids = a_used_efp_ids | z_used_efp_ids
+                    used_ip_sla_ids = a_used_ip_sla_ids | z_used_ip_sla_ids
+
+                efp_ids: List[int] = allocate_n_ids(used_efp_ids, args.n, efp_start, 4094)
+                ip_sla_ids: List[int] = allocate_n_ids(used_ip_sla_ids, 2 * args.n, ip_sla_start, 2147483647)
+
+                if len(efp_ids) < args.n or len(ip_sla_ids) < 2 * args.n:
+                    print(f'Only enough free EFP/IP SLA IDs to provision {min(len(efp_ids), len(ip_sla_ids) // 2)} of the {args.n} requested test L2VPNs.')
+
+                ccm_interval: str = f'{args.ccm_interval}s'
+                a_configs: List[str] = []
+                z_configs: List[str] = []
+                a_deprovision_configs: List[str] = []
+                z_deprovision_configs: List[str] = []
+
+                for vlan, slm_id, dmm_id in zip(efp_ids, ip_sla_ids[0::2], ip_sla_ids[1::2]):
+                    circuit_id: str = f'{vlan:04d}'
+                    vcid: str = f'500{circuit_id}'
+
+                    a_l2vpn = L2VPN(circuit_id=circuit_id, vcid=vcid, interface=args.a_device_interface, vlan=vlan, peer_router_loopback_ip_address=args.z_device_loopback_ip_address, source_mpid=1, target_mpid=2, slm_ip_sla_id=slm_id, dmm_ip_sla_id=dmm_id, ccm_interval=ccm_interval, cfm_domain=CFM_DOMAIN, cfm_level=CFM_LEVEL, enable_cfm_hw_offload=args.hw_offload)
+                    a_configs.append(render_l2vpn(a_l2vpn))
+                    z_l2vpn = L2VPN(circuit_id=circuit_id, vcid=vcid, interface=args.z_device_interface, vlan=vlan, peer_router_loopback_ip_address=args.a_device_loopback_ip_address, source_mpid=2, target_mpid=1, slm_ip_sla_id=slm_id, dmm_ip_sla_id=dmm_id, ccm_interval=ccm_interval, cfm_domain=CFM_DOMAIN, cfm_level=CFM_LEVEL, enable_cfm_hw_offload=args.hw_offload)
+                    z_configs.append(render_l2vpn(z_l2vpn))
+
+                    if not args.dry_run:
+                        a_deprovision_configs.append(render_l2vpn_deprovision(a_l2vpn))
+                        z_deprovision_configs.append(render_l2vpn_deprovision(z_l2vpn))
+
+                if args.dry_run:
+                    write_configs(a_device_dry_run_filename, a_configs)
+                    write_configs(z_device_dry_run_filename, z_configs)
+                elif a_configs:
+                    a_config_future = executor.submit(push_config, a_device, a_configs)
+                    z_config_future = executor.submit(push_config, z_device, z_configs)
+                    wait((a_config_future, z_config_future))
+
+                    if a_config_future.exception() is None:
+                        write_configs(a_device_deprovision_filename, a_deprovision_configs)
+                    if z_config_future.exception() is None:
+                        write_configs(z_device_deprovision_filename, z_deprovision_configs)
+                    if a_config_future.exception() is None or z_config_future.exception() is None:
+                        save_state(state_filename, max(used_efp_ids) + 1, max(used_ip_sla_ids) + 1)
+                    a_config_future.result()
+                    z_config_future.result()
+
+            elif args.subcommand == 'deprovision':
+                a_deprovision_future = executor.submit(deprovision_device, a_device, a_device_deprovision_filename)
+                z_deprovision_future = executor.submit(deprovision_device, z_device, z_device_deprovision_filename)
+                wait((a_deprovision_future, z_deprovision_future))
+                a_deprovision_future.result()
+                z_deprovision_future.result()
+
+                if os.path.exists(state_filename):
+                    os.remove(state_filename)
+        finally:
+            connected_devices: List[ConnectHandler] = [device_future.result() for device_future in (a_device_future, z_device_future) if device_future.exception() is None]
+            wait([executor.submit(device.disconnect) for device in connected_devices])
 
     print(f'Script took {datetime.now() - startTime} to run.')
 